@@ -0,0 +1,127 @@
+import gzip
+import logging
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from app.database import db
+from app.config import (
+    BACKUP_DIR, BACKUP_KEEP, BACKUP_PAGES_PER_STEP, BACKUP_STEP_SLEEP, BACKUP_MAX_RESTARTS, BACKUP_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+last_backup = None
+
+def is_running():
+    return _lock.locked()
+
+def list_backups():
+    """Lists finished backups, newest first."""
+    if not os.path.isdir(BACKUP_DIR):
+        return []
+    backups = []
+    for name in sorted(os.listdir(BACKUP_DIR), reverse=True):
+        if name.endswith('.db.gz'):
+            stat = os.stat(os.path.join(BACKUP_DIR, name))
+            backups.append({'name': name, 'size': stat.st_size,
+                            'created_at': datetime.fromtimestamp(stat.st_mtime).isoformat()})
+    return backups
+
+def _rotate():
+    for backup in list_backups()[BACKUP_KEEP:]:
+        os.remove(os.path.join(BACKUP_DIR, backup['name']))
+        logger.info(f"Removed old backup {backup['name']}")
+
+class _TooManyRestarts(Exception):
+    pass
+
+def _copy(src, dst, deadline):
+    """Copies `src` into `dst` in small steps, falling back to a single step.
+
+    SQLite restarts a stepped backup whenever another connection writes, so
+    under steady traffic it may never finish. After BACKUP_MAX_RESTARTS
+    restarts the remaining copy is done in one step, which under WAL only
+    holds a read snapshot and does not block writers.
+    """
+    state = {'remaining': None, 'restarts': 0}
+
+    def progress(status, remaining, total):
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Backup did not finish within {BACKUP_TIMEOUT}s")
+        if state['remaining'] is not None and remaining > state['remaining']:
+            state['restarts'] += 1
+            if state['restarts'] > BACKUP_MAX_RESTARTS:
+                raise _TooManyRestarts()
+        state['remaining'] = remaining
+        time.sleep(BACKUP_STEP_SLEEP)
+
+    try:
+        src.backup(dst, pages=BACKUP_PAGES_PER_STEP, progress=progress)
+    except _TooManyRestarts:
+        logger.info(f"Backup restarted {state['restarts']} times by writes, copying in one step")
+        src.backup(dst, pages=-1)
+    if time.monotonic() > deadline:
+        raise TimeoutError(f"Backup did not finish within {BACKUP_TIMEOUT}s")
+
+def run_backup():
+    """Makes a compressed online copy of the database.
+
+    Pages are copied in small steps with a pause after each one, so the bot
+    and the API keep writing while the backup runs (see `_copy`). Backups
+    taking longer than BACKUP_TIMEOUT fail. The copy is checked with
+    `PRAGMA integrity_check` before it replaces the oldest backup.
+    Returns the result dict (also kept in `last_backup`), or None if a backup
+    is already running.
+    """
+    global last_backup
+    if not _lock.acquire(blocking=False):
+        return None
+    try:
+        os.makedirs(BACKUP_DIR, exist_ok=True)
+        name = f"{os.path.splitext(os.path.basename(db.db_name))[0]}-{datetime.now():%Y%m%d-%H%M%S}.db.gz"
+        tmp_path = os.path.join(BACKUP_DIR, f'.{name}.tmp')
+        part_path = os.path.join(BACKUP_DIR, f'.{name}.part')
+        started = time.perf_counter()
+        result = {'name': name, 'started_at': datetime.now().isoformat()}
+        try:
+            src = sqlite3.connect(db.db_name)
+            dst = sqlite3.connect(tmp_path)
+            try:
+                _copy(src, dst, time.monotonic() + BACKUP_TIMEOUT)
+                integrity = dst.execute('PRAGMA integrity_check').fetchone()[0]
+            finally:
+                dst.close()
+                src.close()
+            if integrity != 'ok':
+                raise sqlite3.DatabaseError(f"integrity_check failed: {integrity}")
+
+            with open(tmp_path, 'rb') as raw, gzip.open(part_path, 'wb') as packed:
+                shutil.copyfileobj(raw, packed)
+            os.replace(part_path, os.path.join(BACKUP_DIR, name))
+            _rotate()
+            result.update(status='ok', size=os.path.getsize(os.path.join(BACKUP_DIR, name)))
+            logger.info(f"Backup {name} finished")
+        except Exception as e:
+            result.update(status='error', error=str(e))
+            logger.error(f"Backup {name} failed: {e}")
+        finally:
+            for path in (tmp_path, part_path):
+                if os.path.exists(path):
+                    os.remove(path)
+        result['duration_ms'] = round((time.perf_counter() - started) * 1000, 2)
+        last_backup = result
+        return result
+    finally:
+        _lock.release()
+
+def start_backup():
+    """Runs a backup on a background thread. Returns False if one is already running."""
+    if is_running():
+        return False
+    threading.Thread(target=run_backup, name='db-backup', daemon=True).start()
+    return True
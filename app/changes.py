@@ -0,0 +1,86 @@
+import json
+import threading
+import time
+from datetime import datetime
+
+from flask import Response, stream_with_context
+
+from app.database import db
+from app.config import CHANGES_PAGE_SIZE, SSE_POLL_INTERVAL, SSE_KEEPALIVE, SSE_MAX_SECONDS
+
+# Wakes event streams in this process as soon as a change is committed. Writers
+# in other processes (e.g. the bot) are picked up by polling instead.
+_new_changes = threading.Condition()
+
+def record_change(c, user_id, wishlist_id, kind, entity_id, data=None):
+    """Appends a change on the writer's cursor, so it commits with the write itself."""
+    c.execute('''INSERT INTO changes (user_id, wishlist_id, kind, entity_id, data, created_at)
+                 VALUES (?, ?, ?, ?, ?, ?)''',
+              (user_id, wishlist_id, kind, entity_id, json.dumps(data) if data is not None else None,
+               datetime.now()))
+
+def notify():
+    """Tells waiting event streams that new changes were committed."""
+    with _new_changes:
+        _new_changes.notify_all()
+
+def fetch_changes(since, user_id=None, wishlist_id=None, limit=CHANGES_PAGE_SIZE):
+    """Returns changes after `since` for one user or one wishlist, oldest first."""
+    column, value = ('wishlist_id', wishlist_id) if wishlist_id is not None else ('user_id', user_id)
+    rows = db.execute(
+        f'''SELECT seq, wishlist_id, kind, entity_id, data, created_at FROM changes
+            WHERE {column} = ? AND seq > ? ORDER BY seq LIMIT ?''',
+        (value, since, limit), fetchall=True
+    )
+    return [{
+        'seq': seq, 'wishlist_id': wl_id, 'kind': kind, 'entity_id': entity_id,
+        'data': json.loads(data) if data else None, 'created_at': created_at
+    } for seq, wl_id, kind, entity_id, data, created_at in rows]
+
+def is_pruned(since):
+    """True if changes after `since` may have been pruned, so the client must reload."""
+    if since <= 0:
+        return False
+    oldest = db.execute(
+        '''SELECT COALESCE(MIN(seq), (SELECT seq + 1 FROM sqlite_sequence WHERE name = 'changes'), 1)
+           FROM changes''', fetchone=True
+    )[0]
+    return since < oldest - 1
+
+def changes_page(since, **scope):
+    """JSON body for the `since=` delta endpoints."""
+    changes = fetch_changes(since, **scope)
+    return {
+        'changes': changes,
+        'seq': changes[-1]['seq'] if changes else since,
+        'has_more': len(changes) == CHANGES_PAGE_SIZE,
+        'reset': is_pruned(since)
+    }
+
+def event_stream(since, **scope):
+    """Server-sent events with every change after `since`, for SSE_MAX_SECONDS.
+
+    Each event's id is its sequence number, so a reconnecting EventSource
+    resumes through the Last-Event-ID header. A `reset` event tells the
+    client that `since` is older than the retained log and it must reload.
+    """
+    def generate():
+        last_seq = since
+        deadline = time.monotonic() + SSE_MAX_SECONDS
+        last_sent = time.monotonic()
+        yield f'retry: {SSE_POLL_INTERVAL * 1000}\n\n'
+        if is_pruned(since):
+            yield 'event: reset\ndata: {}\n\n'
+        while time.monotonic() < deadline:
+            for change in fetch_changes(last_seq, **scope):
+                last_seq = change['seq']
+                last_sent = time.monotonic()
+                yield f"id: {change['seq']}\nevent: {change['kind']}\ndata: {json.dumps(change)}\n\n"
+            if time.monotonic() - last_sent >= SSE_KEEPALIVE:
+                last_sent = time.monotonic()
+                yield ': keepalive\n\n'
+            with _new_changes:
+                _new_changes.wait(SSE_POLL_INTERVAL)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
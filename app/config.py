@@ -9,6 +9,16 @@ load_dotenv()
 # Use an environment variable for this.
 BOT_TOKEN = os.environ.get('BOT_TOKEN')
 ADMIN_USER_ID = os.environ.get('ADMIN_USER_ID', '')
+# Point these at a local stub Bot API server for testing
+TELEGRAM_API_URL = os.environ.get('TELEGRAM_API_URL', 'https://api.telegram.org/bot')
+TELEGRAM_FILE_URL = os.environ.get('TELEGRAM_FILE_URL', 'https://api.telegram.org/file/bot')
+
+# --- Outbound Rate Limits ---
+# Telegram allows ~30 messages/s overall and ~1 message/s per chat
+SEND_GLOBAL_RATE = float(os.environ.get('SEND_GLOBAL_RATE', 30))
+SEND_CHAT_RATE = float(os.environ.get('SEND_CHAT_RATE', 1))
+SEND_CHAT_BURST = int(os.environ.get('SEND_CHAT_BURST', 3))
+SEND_MAX_RETRIES = int(os.environ.get('SEND_MAX_RETRIES', 3))
 
 # --- Web App ---
 SECRET_KEY = os.environ.get('SECRET_KEY')
@@ -17,6 +27,67 @@ ENABLE_VALIDATION = os.environ.get('ENABLE_VALIDATION', 'True').lower() == 'true
 # --- Database ---
 DB_NAME = os.environ.get('DB_PATH', 'wishlist.db')
 
+# --- Database Maintenance ---
+# Run the maintenance scheduler inside the web process (or use `python main.py maintenance`)
+MAINTENANCE_ENABLED = os.environ.get('MAINTENANCE_ENABLED', 'False').lower() == 'true'
+OPTIMIZE_INTERVAL = int(os.environ.get('OPTIMIZE_INTERVAL', 3600))
+ANALYZE_INTERVAL = int(os.environ.get('ANALYZE_INTERVAL', 86400))
+VACUUM_INTERVAL = int(os.environ.get('VACUUM_INTERVAL', 3600))
+VACUUM_PAGES = int(os.environ.get('VACUUM_PAGES', 256))
+# The WAL is checkpointed more often the closer it gets to WAL_CHECKPOINT_BYTES
+WAL_CHECKPOINT_BYTES = int(os.environ.get('WAL_CHECKPOINT_BYTES', 4 * 1024 * 1024))
+WAL_CHECKPOINT_MIN_INTERVAL = int(os.environ.get('WAL_CHECKPOINT_MIN_INTERVAL', 30))
+WAL_CHECKPOINT_MAX_INTERVAL = int(os.environ.get('WAL_CHECKPOINT_MAX_INTERVAL', 600))
+# Tasks wait until the API has been idle this long, but never longer than MAINTENANCE_MAX_DEFER
+MAINTENANCE_IDLE_MS = int(os.environ.get('MAINTENANCE_IDLE_MS', 200))
+MAINTENANCE_MAX_DEFER = int(os.environ.get('MAINTENANCE_MAX_DEFER', 60))
+
+# --- Backups ---
+BACKUP_DIR = os.environ.get('BACKUP_DIR', 'backups')
+# Scheduled backup period in seconds (0 disables); runs with the maintenance scheduler
+BACKUP_INTERVAL = int(os.environ.get('BACKUP_INTERVAL', 86400))
+BACKUP_KEEP = int(os.environ.get('BACKUP_KEEP', 7))
+# Pages copied per step and pause between steps, so writers are never blocked for long
+BACKUP_PAGES_PER_STEP = int(os.environ.get('BACKUP_PAGES_PER_STEP', 64))
+BACKUP_STEP_SLEEP = float(os.environ.get('BACKUP_STEP_SLEEP', 0.05))
+# Writes restart a stepped backup; after this many restarts the rest is copied in one step
+BACKUP_MAX_RESTARTS = int(os.environ.get('BACKUP_MAX_RESTARTS', 3))
+# A backup still running after this many seconds is abandoned and reported as failed
+BACKUP_TIMEOUT = int(os.environ.get('BACKUP_TIMEOUT', 600))
+
+# --- Image Proxy ---
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', 'image_cache')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 512 * 1024 * 1024))
+IMAGE_MAX_BYTES = int(os.environ.get('IMAGE_MAX_BYTES', 10 * 1024 * 1024))
+# Larger images are refused instead of being decoded for thumbnails
+IMAGE_MAX_PIXELS = int(os.environ.get('IMAGE_MAX_PIXELS', 40_000_000))
+IMAGE_FETCH_TIMEOUT = int(os.environ.get('IMAGE_FETCH_TIMEOUT', 10))
+IMAGE_THUMB_SIZE = int(os.environ.get('IMAGE_THUMB_SIZE', 320))
+# Browser cache lifetime; after it the ETag is revalidated
+IMAGE_MAX_AGE = int(os.environ.get('IMAGE_MAX_AGE', 3600))
+# Only enable for local testing against a stub image server
+IMAGE_ALLOW_PRIVATE_HOSTS = os.environ.get('IMAGE_ALLOW_PRIVATE_HOSTS', 'False').lower() == 'true'
+
+# --- Change Feed ---
+CHANGES_PAGE_SIZE = int(os.environ.get('CHANGES_PAGE_SIZE', 500))
+# Event streams re-check the change log at least this often (seconds)
+SSE_POLL_INTERVAL = int(os.environ.get('SSE_POLL_INTERVAL', 2))
+SSE_KEEPALIVE = int(os.environ.get('SSE_KEEPALIVE', 15))
+# Streams close after this long; EventSource reconnects with Last-Event-ID
+SSE_MAX_SECONDS = int(os.environ.get('SSE_MAX_SECONDS', 300))
+# Changes older than this are pruned by the maintenance scheduler
+CHANGES_RETENTION_DAYS = int(os.environ.get('CHANGES_RETENTION_DAYS', 30))
+CHANGES_PRUNE_INTERVAL = int(os.environ.get('CHANGES_PRUNE_INTERVAL', 86400))
+
+# --- Profiler ---
+# Admins can switch sampling on at runtime via /api/admin/profiler
+PROFILER_ENABLED = os.environ.get('PROFILER_ENABLED', 'False').lower() == 'true'
+PROFILER_SAMPLE_RATE = float(os.environ.get('PROFILER_SAMPLE_RATE', 0.01))
+PROFILER_INTERVAL_MS = float(os.environ.get('PROFILER_INTERVAL_MS', 5))
+# Requests with `X-Profile: <token>` are always profiled (empty disables the header)
+PROFILER_TOKEN = os.environ.get('PROFILER_TOKEN', '')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+
 # --- Monetization ---
 # These are default values. They will be stored in the DB after first launch.
 DEFAULT_SETTINGS = {
@@ -1,10 +1,50 @@
 import sqlite3
 import os
+import time
+from contextlib import contextmanager
 from datetime import datetime
 import logging
 
 logger = logging.getLogger(__name__)
 
+class TimedCursor(sqlite3.Cursor):
+    """Reports the duration of each query to its connection's `query_hook`."""
+
+    def execute(self, query, params=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, params)
+        finally:
+            self.connection.query_hook(query, time.perf_counter() - started)
+
+    def executemany(self, query, params):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, params)
+        finally:
+            self.connection.query_hook(query, time.perf_counter() - started)
+
+class TimedConnection(sqlite3.Connection):
+    """A connection whose cursors (including `conn.execute`) are TimedCursors."""
+
+    query_hook = None
+
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, query, params=()):
+        return self.cursor().execute(query, params)
+
+    def executemany(self, query, params):
+        return self.cursor().executemany(query, params)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.query_hook('COMMIT', time.perf_counter() - started)
+
 class Database:
     def __init__(self, db_name=None):
         if db_name is None:
@@ -13,16 +53,26 @@ class Database:
             if not os.path.exists(db_name) and os.path.exists(os.path.join('..', db_name)):
                 db_name = os.path.join('..', db_name)
         self.db_name = db_name
+        # Called as query_hook(query, seconds) after each query while the profiler runs
+        self.query_hook = None
         self.init_db()
 
     def get_connection(self):
         """Creates a new database connection."""
-        return sqlite3.connect(self.db_name)
+        if self.query_hook is None:
+            return sqlite3.connect(self.db_name)
+        conn = sqlite3.connect(self.db_name, factory=TimedConnection)
+        conn.query_hook = self.query_hook
+        return conn
 
     def init_db(self):
         """Initializes the database schema."""
         with self.get_connection() as conn:
             c = conn.cursor()
+            # auto_vacuum only takes effect on a fresh database (or after a full VACUUM);
+            # WAL lets readers and the maintenance tasks run alongside writers.
+            c.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            c.execute('PRAGMA journal_mode = WAL')
             c.execute('''CREATE TABLE IF NOT EXISTS users
                          (user_id INTEGER PRIMARY KEY,
                           username TEXT,
@@ -52,8 +102,72 @@ class Database:
                          (key TEXT PRIMARY KEY,
                           value TEXT,
                           updated_at TIMESTAMP)''')
+
+            # Slots per user (wishlist_id = 0: wishlists) and per wishlist (items). Free slots
+            # are stored as used, so a change to `free_wishlist_items` applies to every wishlist;
+            # unpaid_slots counts rows created with no slot left and not paid for yet
+            c.execute('''CREATE TABLE IF NOT EXISTS entitlements
+                         (user_id INTEGER NOT NULL,
+                          wishlist_id INTEGER NOT NULL DEFAULT 0,
+                          free_used INTEGER NOT NULL DEFAULT 0,
+                          paid_slots INTEGER NOT NULL DEFAULT 0,
+                          unpaid_slots INTEGER NOT NULL DEFAULT 0,
+                          updated_at TIMESTAMP,
+                          PRIMARY KEY (user_id, wishlist_id))''')
+
+            # Image proxy: source URL/file ID -> content-addressed blob in the image cache
+            c.execute('''CREATE TABLE IF NOT EXISTS images
+                         (key TEXT PRIMARY KEY,
+                          source TEXT UNIQUE,
+                          content_hash TEXT,
+                          content_type TEXT,
+                          fetched_at TIMESTAMP,
+                          created_at TIMESTAMP)''')
+
+            # Append-only log of wishlist/item changes for the delta and event stream APIs
+            c.execute('''CREATE TABLE IF NOT EXISTS changes
+                         (seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                          user_id INTEGER,
+                          wishlist_id INTEGER,
+                          kind TEXT,
+                          entity_id INTEGER,
+                          data TEXT,
+                          created_at TIMESTAMP)''')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_changes_user ON changes (user_id, seq)')
+            c.execute('CREATE INDEX IF NOT EXISTS idx_changes_wishlist ON changes (wishlist_id, seq)')
+
+            # Run statistics of the maintenance tasks, shared by the web app and `main.py maintenance`
+            c.execute('''CREATE TABLE IF NOT EXISTS maintenance_runs
+                         (name TEXT PRIMARY KEY,
+                          runs INTEGER NOT NULL DEFAULT 0,
+                          failures INTEGER NOT NULL DEFAULT 0,
+                          last_run REAL,
+                          last_duration_ms REAL,
+                          total_duration_ms REAL NOT NULL DEFAULT 0,
+                          last_error TEXT)''')
+
+            # status: 'credited', or 'refund_due' when the payload matched nothing to credit
+            c.execute('''CREATE TABLE IF NOT EXISTS payments
+                         (charge_id TEXT PRIMARY KEY,
+                          user_id INTEGER,
+                          payload TEXT,
+                          amount INTEGER,
+                          status TEXT NOT NULL DEFAULT 'credited',
+                          created_at TIMESTAMP)''')
             conn.commit()
 
+    @contextmanager
+    def read_transaction(self):
+        """Yields a cursor whose queries all see the same snapshot, on one connection."""
+        conn = self.get_connection()
+        try:
+            c = conn.cursor()
+            c.execute('BEGIN')
+            yield c
+            conn.commit()
+        finally:
+            conn.close()
+
     def execute(self, query, params=(), fetchone=False, fetchall=False, commit=False):
         """A generic method to execute queries."""
         with self.get_connection() as conn:
@@ -105,3 +219,136 @@ def init_default_settings(settings_dict):
         else:
             logger.info("Settings already initialized.")
 
+
+# --- Entitlements ---
+#
+# The ledger functions take the caller's cursor, so a slot is taken or given
+# back in the same transaction as the row that uses it. Writers start that
+# transaction with BEGIN IMMEDIATE, so the ledger reads below cannot go stale.
+
+def _free_limit(c, wishlist_id):
+    """Free slots of a ledger row: one free wishlist per user, and the current
+    `free_wishlist_items` setting for the items of a free wishlist."""
+    if wishlist_id == 0:
+        return 1
+    c.execute('SELECT is_free FROM wishlists WHERE id = ?', (wishlist_id,))
+    row = c.fetchone()
+    if not row or not row[0]:
+        return 0
+    c.execute("SELECT value FROM settings WHERE key = 'free_wishlist_items'")
+    row = c.fetchone()
+    return int(row[0]) if row else 0
+
+def _initial_free_used(c, user_id, wishlist_id):
+    """Free slots already used by the wishlists/items created before the ledger row."""
+    if wishlist_id == 0:
+        c.execute('SELECT COUNT(*) FROM wishlists WHERE user_id = ?', (user_id,))
+    else:
+        c.execute('SELECT COUNT(*) FROM items WHERE wishlist_id = ?', (wishlist_id,))
+    return min(c.fetchone()[0], _free_limit(c, wishlist_id))
+
+def _seed_entitlement(c, user_id, wishlist_id):
+    """Creates the ledger row for a user or wishlist from its current contents, if missing."""
+    c.execute('SELECT 1 FROM entitlements WHERE user_id = ? AND wishlist_id = ?', (user_id, wishlist_id))
+    if c.fetchone():
+        return
+    c.execute('''INSERT OR IGNORE INTO entitlements (user_id, wishlist_id, free_used, paid_slots, updated_at)
+                 VALUES (?, ?, ?, 0, ?)''', (user_id, wishlist_id, _initial_free_used(c, user_id, wishlist_id),
+                                            datetime.now()))
+
+def read_entitlement(c, user_id, wishlist_id=0):
+    """Returns `(free_slots, paid_slots)` for a user (wishlist_id=0) or one of their wishlists.
+
+    Only reads: a missing ledger row is computed the way it would be seeded.
+    """
+    c.execute('SELECT free_used, paid_slots FROM entitlements WHERE user_id = ? AND wishlist_id = ?',
+              (user_id, wishlist_id))
+    row = c.fetchone()
+    free_used, paid_slots = row if row else (_initial_free_used(c, user_id, wishlist_id), 0)
+    return max(_free_limit(c, wishlist_id) - free_used, 0), paid_slots
+
+def get_entitlement(user_id, wishlist_id=0):
+    """Returns `(free_slots, paid_slots)` for a user (wishlist_id=0) or one of their wishlists."""
+    with db.read_transaction() as c:
+        return read_entitlement(c, user_id, wishlist_id)
+
+def consume_slot(c, user_id, wishlist_id=0):
+    """Takes one slot, preferring free ones.
+
+    Returns 'free' or 'paid' for the slot taken, or None if nothing is left
+    (counted as unpaid: the Mini App has no payment flow yet, so such rows
+    are still created, with is_free = 0).
+    """
+    free_limit = _free_limit(c, wishlist_id)
+    _seed_entitlement(c, user_id, wishlist_id)
+    updates = (
+        ('free', 'free_used = free_used + 1', 'free_used < ?', (free_limit,)),
+        ('paid', 'paid_slots = paid_slots - 1', 'paid_slots > 0', ()),
+        (None, 'unpaid_slots = unpaid_slots + 1', '1', ()),
+    )
+    for kind, change, condition, params in updates:
+        c.execute(f'''UPDATE entitlements SET {change}, updated_at = ?
+                      WHERE user_id = ? AND wishlist_id = ? AND {condition}''',
+                  (datetime.now(), user_id, wishlist_id, *params))
+        if c.rowcount:
+            return kind
+
+def release_slot(c, user_id, wishlist_id, is_free):
+    """Gives back a slot when the wishlist or item that used it is deleted.
+
+    Deleting a non-free row settles an unpaid one first, so only slots that
+    were paid for are given back.
+    """
+    if is_free:
+        change, condition = 'free_used = free_used - 1', 'free_used > 0'
+    else:
+        c.execute('''UPDATE entitlements SET unpaid_slots = unpaid_slots - 1, updated_at = ?
+                     WHERE user_id = ? AND wishlist_id = ? AND unpaid_slots > 0''',
+                  (datetime.now(), user_id, wishlist_id))
+        if c.rowcount:
+            return
+        change, condition = 'paid_slots = paid_slots + 1', '1'
+    c.execute(f'''UPDATE entitlements SET {change}, updated_at = ?
+                  WHERE user_id = ? AND wishlist_id = ? AND {condition}''',
+              (datetime.now(), user_id, wishlist_id))
+
+def init_wishlist_entitlement(c, user_id, wishlist_id):
+    """Creates the item slots for a freshly created wishlist."""
+    c.execute('''INSERT OR IGNORE INTO entitlements (user_id, wishlist_id, free_used, paid_slots, updated_at)
+                 VALUES (?, ?, 0, 0, ?)''', (user_id, wishlist_id, datetime.now()))
+
+def delete_wishlist_entitlement(c, user_id, wishlist_id):
+    """Drops the item slots of a deleted wishlist."""
+    c.execute('DELETE FROM entitlements WHERE user_id = ? AND wishlist_id = ?', (user_id, wishlist_id))
+
+def credit_payment(charge_id, user_id, wishlist_id, payload, amount):
+    """Records a payment and credits one paid slot.
+
+    Idempotent on the Telegram charge ID: returns False if the charge was
+    already credited.
+    """
+    with db.get_connection() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('''INSERT OR IGNORE INTO payments (charge_id, user_id, payload, amount, created_at)
+                     VALUES (?, ?, ?, ?, ?)''', (charge_id, user_id, payload, amount, datetime.now()))
+        if not c.rowcount:
+            return False
+        _seed_entitlement(c, user_id, wishlist_id)
+        c.execute('''UPDATE entitlements SET paid_slots = paid_slots + 1, updated_at = ?
+                     WHERE user_id = ? AND wishlist_id = ?''', (datetime.now(), user_id, wishlist_id))
+        conn.commit()
+        return True
+
+def record_refund_due(charge_id, user_id, payload, amount):
+    """Records a payment that could not be credited (e.g. its wishlist is gone) for refund.
+
+    Idempotent on the Telegram charge ID: returns False if the charge was
+    already recorded.
+    """
+    with db.get_connection() as conn:
+        c = conn.cursor()
+        c.execute('''INSERT OR IGNORE INTO payments (charge_id, user_id, payload, amount, status, created_at)
+                     VALUES (?, ?, ?, ?, 'refund_due', ?)''', (charge_id, user_id, payload, amount, datetime.now()))
+        conn.commit()
+        return bool(c.rowcount)
@@ -0,0 +1,324 @@
+import hashlib
+import http.client
+import io
+import ipaddress
+import json
+import logging
+import os
+import socket
+import threading
+import time
+import urllib.request
+from datetime import datetime
+from urllib.parse import urlsplit, quote
+
+from app.database import db
+from app.config import (
+    BOT_TOKEN, TELEGRAM_API_URL, TELEGRAM_FILE_URL, IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES,
+    IMAGE_MAX_BYTES, IMAGE_MAX_PIXELS, IMAGE_FETCH_TIMEOUT, IMAGE_THUMB_SIZE, IMAGE_ALLOW_PRIVATE_HOSTS
+)
+
+try:
+    from PIL import Image
+except ImportError:  # Thumbnails fall back to the original image
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+class ImageError(Exception):
+    """Raised when an image cannot be fetched or decoded."""
+
+# --- Keys ---
+
+def image_key(source):
+    """Stable key for an image source (URL or Telegram file ID)."""
+    return hashlib.sha256(source.encode()).hexdigest()[:32]
+
+def register_images(sources):
+    """Makes image sources reachable through /api/img/<key>."""
+    rows = [(image_key(source), source, datetime.now()) for source in set(sources) if source]
+    if rows:
+        with db.get_connection() as conn:
+            conn.executemany('INSERT OR IGNORE INTO images (key, source, created_at) VALUES (?, ?, ?)', rows)
+            conn.commit()
+
+def backfill_images():
+    """Registers images of items created before the proxy existed."""
+    sources = db.execute(
+        '''SELECT DISTINCT image_url FROM items WHERE image_url IS NOT NULL
+           AND image_url NOT IN (SELECT source FROM images)''', fetchall=True
+    )
+    register_images(source for source, in sources)
+
+# --- Fetching ---
+
+def _check_url(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ('http', 'https') or not parts.hostname:
+        raise ImageError(f"Unsupported image URL: {url}")
+
+def _connect_public(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """Resolves the host once, checks the addresses and connects to one of them.
+
+    Connecting to the checked address itself means a DNS answer that changes
+    between the check and the connect cannot point the proxy at a private host.
+    """
+    host, port = address
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except socket.gaierror as e:
+        raise ImageError(f"Cannot resolve {host}: {e}")
+    if not IMAGE_ALLOW_PRIVATE_HOSTS:
+        for *_, sockaddr in addresses:
+            if not ipaddress.ip_address(sockaddr[0]).is_global:
+                raise ImageError(f"Refusing to fetch from non-public host {host}")
+    error = None
+    for family, sock_type, proto, _, sockaddr in addresses:
+        sock = socket.socket(family, sock_type, proto)
+        try:
+            if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                sock.settimeout(timeout)
+            if source_address:
+                sock.bind(source_address)
+            sock.connect(sockaddr)
+            return sock
+        except OSError as e:
+            sock.close()
+            error = e
+    raise error
+
+class _CheckedHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+class _CheckedHTTPSConnection(http.client.HTTPSConnection):
+    # TLS still verifies the certificate against the host name, not the IP
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._create_connection = _connect_public
+
+class _CheckedHTTPHandler(urllib.request.HTTPHandler):
+    def http_open(self, req):
+        return self.do_open(_CheckedHTTPConnection, req)
+
+class _CheckedHTTPSHandler(urllib.request.HTTPSHandler):
+    def https_open(self, req):
+        return self.do_open(_CheckedHTTPSConnection, req, context=self._context)
+
+class _CheckedRedirectHandler(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        _check_url(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+# No proxies: the address checks only hold for direct connections
+_opener = urllib.request.build_opener(
+    urllib.request.ProxyHandler({}), _CheckedHTTPHandler, _CheckedHTTPSHandler, _CheckedRedirectHandler
+)
+
+def _download(url):
+    _check_url(url)
+    request = urllib.request.Request(url, headers={'User-Agent': 'iWishBot image proxy'})
+    with _opener.open(request, timeout=IMAGE_FETCH_TIMEOUT) as response:
+        data = response.read(IMAGE_MAX_BYTES + 1)
+    if len(data) > IMAGE_MAX_BYTES:
+        raise ImageError(f"Image is larger than {IMAGE_MAX_BYTES} bytes")
+    return data
+
+def _fetch_source(source):
+    """Downloads an image URL, or a Telegram photo by file ID."""
+    try:
+        return _fetch_source_unchecked(source)
+    except (OSError, ValueError, KeyError, http.client.HTTPException) as e:
+        raise ImageError(f"Could not fetch {source}: {e}")
+
+def _fetch_source_unchecked(source):
+    if source.startswith(('http://', 'https://')):
+        data = _download(source)
+    else:
+        if not BOT_TOKEN:
+            raise ImageError("BOT_TOKEN is required to fetch Telegram files")
+        with urllib.request.urlopen(f"{TELEGRAM_API_URL}{BOT_TOKEN}/getFile?file_id={quote(source)}",
+                                    timeout=IMAGE_FETCH_TIMEOUT) as response:
+            result = json.load(response)
+        if not result.get('ok'):
+            raise ImageError(f"getFile failed: {result.get('description')}")
+        with urllib.request.urlopen(f"{TELEGRAM_FILE_URL}{BOT_TOKEN}/{result['result']['file_path']}",
+                                    timeout=IMAGE_FETCH_TIMEOUT) as response:
+            data = response.read(IMAGE_MAX_BYTES + 1)
+        if len(data) > IMAGE_MAX_BYTES:
+            raise ImageError(f"Image is larger than {IMAGE_MAX_BYTES} bytes")
+    return data, _raster_type(data)
+
+# Only these are served: an SVG (or HTML passed off as an image) could run script on our origin
+_RASTER_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png', 'GIF': 'image/gif', 'WEBP': 'image/webp'}
+
+def _check_pixels(image):
+    # Decoding cost grows with the pixel count, not the (possibly tiny) file size
+    width, height = image.size
+    if width * height > IMAGE_MAX_PIXELS:
+        raise ImageError(f"Image is larger than {IMAGE_MAX_PIXELS} pixels")
+
+def _sniff_format(data):
+    if data.startswith(b'\xff\xd8\xff'):
+        return 'JPEG'
+    if data.startswith(b'\x89PNG\r\n\x1a\n'):
+        return 'PNG'
+    if data.startswith((b'GIF87a', b'GIF89a')):
+        return 'GIF'
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'WEBP'
+    return None
+
+def _raster_type(data):
+    """Returns the content type of a JPEG/PNG/GIF/WebP image, ignoring what the origin claimed."""
+    image_format = _sniff_format(data)
+    if Image is not None:
+        try:
+            with Image.open(io.BytesIO(data)) as image:
+                _check_pixels(image)
+                image.verify()
+                image_format = image.format
+        except ImageError:
+            raise
+        except Exception:  # Pillow raises many error types for bad input
+            image_format = None
+    if image_format not in _RASTER_TYPES:
+        raise ImageError("Not a JPEG, PNG, GIF or WebP image")
+    return _RASTER_TYPES[image_format]
+
+# --- Cache ---
+
+_cache_lock = threading.Lock()
+_cache_bytes = None
+_inflight = {}
+
+def _blob_path(content_hash, suffix=''):
+    return os.path.join(os.path.abspath(IMAGE_CACHE_DIR), content_hash[:2], content_hash + suffix)
+
+def _cache_files():
+    for root, _, files in os.walk(IMAGE_CACHE_DIR):
+        for name in files:
+            if name.endswith('.tmp'):
+                continue  # Another writer's file, not yet in the cache
+            path = os.path.join(root, name)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            yield path, stat
+
+def _store(path, data):
+    """Writes a cache file atomically and evicts least recently used files over the limit."""
+    global _cache_bytes
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+    with _cache_lock:
+        if _cache_bytes is None:
+            _cache_bytes = sum(stat.st_size for _, stat in _cache_files())
+        else:
+            _cache_bytes += len(data)
+        if _cache_bytes <= IMAGE_CACHE_MAX_BYTES:
+            return
+        # Hits bump the mtime, so the oldest mtime is the least recently used
+        files = sorted(_cache_files(), key=lambda entry: entry[1].st_mtime)
+        _cache_bytes = sum(stat.st_size for _, stat in files)
+        target = IMAGE_CACHE_MAX_BYTES * 0.9
+        for old_path, stat in files:
+            if _cache_bytes <= target:
+                break
+            if old_path == path:
+                continue
+            try:
+                os.remove(old_path)
+                _cache_bytes -= stat.st_size
+            except FileNotFoundError:
+                pass
+
+def _touch(path):
+    try:
+        os.utime(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def _single_flight(key, produce):
+    """Runs `produce()` once per key; concurrent callers wait for that run instead."""
+    with _cache_lock:
+        event = _inflight.get(key)
+        leader = event is None
+        if leader:
+            event = _inflight[key] = threading.Event()
+    if not leader:
+        event.wait(IMAGE_FETCH_TIMEOUT * 3)
+        return
+    try:
+        produce()
+    finally:
+        with _cache_lock:
+            del _inflight[key]
+        event.set()
+
+def _make_thumbnail(data):
+    image = Image.open(io.BytesIO(data))
+    _check_pixels(image)
+    # Lets JPEG decode at a reduced scale instead of full size
+    image.draft('RGB', (IMAGE_THUMB_SIZE, IMAGE_THUMB_SIZE))
+    image.thumbnail((IMAGE_THUMB_SIZE, IMAGE_THUMB_SIZE))
+    if image.mode not in ('RGB', 'L'):
+        background = Image.new('RGB', image.size, (255, 255, 255))
+        background.paste(image.convert('RGBA'), mask=image.convert('RGBA').split()[-1])
+        image = background
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=80, optimize=True)
+    return out.getvalue()
+
+def get_image(key, thumb=False):
+    """Returns `(path, content_type, etag)` of a cached image, fetching it on first use.
+
+    Returns None for unknown keys and raises ImageError if the origin fails.
+    """
+    row = db.execute('SELECT source, content_hash, content_type FROM images WHERE key = ?', (key,), fetchone=True)
+    if not row:
+        return None
+    source, content_hash, content_type = row
+
+    # Rows cached before raster-only validation are fetched and checked again
+    if not content_hash or content_type not in _RASTER_TYPES.values() or not _touch(_blob_path(content_hash)):
+        def fetch():
+            started = time.perf_counter()
+            data, fetched_type = _fetch_source(source)
+            fetched_hash = hashlib.sha256(data).hexdigest()
+            _store(_blob_path(fetched_hash), data)
+            db.execute('UPDATE images SET content_hash = ?, content_type = ?, fetched_at = ? WHERE key = ?',
+                       (fetched_hash, fetched_type, datetime.now(), key), commit=True)
+            logger.info(f"Fetched image {key} in {(time.perf_counter() - started) * 1000:.0f} ms")
+
+        _single_flight(key, fetch)
+        row = db.execute('SELECT content_hash, content_type FROM images WHERE key = ?', (key,), fetchone=True)
+        content_hash, content_type = row
+        if not content_hash or not os.path.exists(_blob_path(content_hash)):
+            raise ImageError(f"Could not fetch image {key}")
+
+    if not thumb or Image is None:
+        return _blob_path(content_hash), content_type, content_hash
+
+    suffix = f'.thumb{IMAGE_THUMB_SIZE}.jpg'
+    thumb_path = _blob_path(content_hash, suffix)
+    if not _touch(thumb_path):
+        def render():
+            with open(_blob_path(content_hash), 'rb') as f:
+                data = f.read()
+            try:
+                _store(thumb_path, _make_thumbnail(data))
+            except Exception as e:  # Pillow raises many error types for bad input
+                raise ImageError(f"Cannot make thumbnail for {key}: {e}")
+
+        _single_flight(content_hash + suffix, render)
+        if not os.path.exists(thumb_path):
+            raise ImageError(f"Could not make thumbnail for {key}")
+    return thumb_path, 'image/jpeg', f'{content_hash}-t{IMAGE_THUMB_SIZE}'
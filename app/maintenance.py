@@ -0,0 +1,260 @@
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timedelta
+
+from app.database import db
+from app.backup import run_backup
+from app.config import (
+    BACKUP_INTERVAL, CHANGES_RETENTION_DAYS, CHANGES_PRUNE_INTERVAL, OPTIMIZE_INTERVAL, ANALYZE_INTERVAL, VACUUM_INTERVAL, VACUUM_PAGES,
+    WAL_CHECKPOINT_BYTES, WAL_CHECKPOINT_MIN_INTERVAL, WAL_CHECKPOINT_MAX_INTERVAL,
+    MAINTENANCE_IDLE_MS, MAINTENANCE_MAX_DEFER
+)
+
+logger = logging.getLogger(__name__)
+
+# --- Foreground Activity ---
+
+class ActivityTracker:
+    """Counts in-flight requests so background work can wait for a quiet moment.
+
+    Requests starting and finishing also bump the mtime of `signal_path`
+    (at most every `touch_interval` seconds), so a scheduler in another
+    process (`python main.py maintenance`) sees the traffic too. That
+    process only learns when requests start and end, not that one is still
+    running.
+    """
+
+    def __init__(self, signal_path=None, touch_interval=0.05):
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last_active = time.monotonic()
+        self._signal_path = signal_path
+        self._touch_interval = touch_interval
+        self._last_touch = 0.0
+
+    def _signal(self):
+        now = time.monotonic()
+        if not self._signal_path or now - self._last_touch < self._touch_interval:
+            return
+        self._last_touch = now
+        try:
+            try:
+                os.utime(self._signal_path)
+            except FileNotFoundError:
+                open(self._signal_path, 'a').close()
+        except OSError as e:
+            # Never let the signal break the request that sends it
+            logger.debug(f"Cannot update activity file {self._signal_path}: {e}")
+
+    def enter(self):
+        with self._lock:
+            self._active += 1
+        self._signal()
+
+    def leave(self):
+        with self._lock:
+            self._active = max(self._active - 1, 0)
+            self._last_active = time.monotonic()
+        self._signal()
+
+    def idle_for(self):
+        """Seconds since the last request in any process, or 0 while one runs here."""
+        with self._lock:
+            if self._active:
+                return 0
+            idle = time.monotonic() - self._last_active
+        if self._signal_path:
+            try:
+                idle = min(idle, max(time.time() - os.stat(self._signal_path).st_mtime, 0))
+            except OSError:
+                pass
+        return idle
+
+    def wait_idle(self, idle_seconds, max_wait, stop_event=None):
+        """Blocks until there was no traffic for `idle_seconds` or `max_wait` has passed."""
+        deadline = time.monotonic() + max_wait
+        while time.monotonic() < deadline:
+            idle = self.idle_for()
+            if idle >= idle_seconds:
+                return True
+            if stop_event and stop_event.wait(idle_seconds - idle):
+                return False
+            if not stop_event:
+                time.sleep(idle_seconds - idle)
+        return False
+
+activity = ActivityTracker(f'{db.db_name}.activity', MAINTENANCE_IDLE_MS / 4000)
+
+# --- Tasks ---
+
+def optimize(conn):
+    conn.execute('PRAGMA optimize')
+
+def analyze(conn):
+    conn.execute('ANALYZE')
+
+def incremental_vacuum(conn):
+    """Returns free pages to the OS in small chunks, pausing for traffic in between."""
+    if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+        logger.debug("auto_vacuum is not INCREMENTAL, skipping incremental_vacuum")
+        return
+    while conn.execute('PRAGMA freelist_count').fetchone()[0] > 0:
+        conn.execute(f'PRAGMA incremental_vacuum({VACUUM_PAGES})').fetchall()
+        activity.wait_idle(MAINTENANCE_IDLE_MS / 1000, MAINTENANCE_MAX_DEFER)
+
+def prune_changes(conn):
+    """Deletes changes past the retention period in small batches, pausing for traffic in between."""
+    cutoff = datetime.now() - timedelta(days=CHANGES_RETENTION_DAYS)
+    while True:
+        deleted = conn.execute(
+            '''DELETE FROM changes WHERE seq IN
+               (SELECT seq FROM changes WHERE created_at < ? ORDER BY seq LIMIT 1000)''', (cutoff,)
+        ).rowcount
+        conn.commit()
+        if deleted < 1000:
+            return
+        activity.wait_idle(MAINTENANCE_IDLE_MS / 1000, MAINTENANCE_MAX_DEFER)
+
+def checkpoint_wal(conn):
+    """Checkpoints the WAL and returns when to run again.
+
+    A WAL past WAL_CHECKPOINT_BYTES is truncated right away and checked
+    again soon; a small one gets a passive checkpoint and a longer interval.
+    """
+    wal_path = db.db_name + '-wal'
+    wal_size = os.path.getsize(wal_path) if os.path.exists(wal_path) else 0
+    if wal_size >= WAL_CHECKPOINT_BYTES:
+        conn.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchone()
+        return WAL_CHECKPOINT_MIN_INTERVAL
+    conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    fill = wal_size / WAL_CHECKPOINT_BYTES
+    interval = WAL_CHECKPOINT_MAX_INTERVAL * (1 - fill)
+    return max(WAL_CHECKPOINT_MIN_INTERVAL, interval)
+
+def backup(conn):
+    """Online backup; it opens its own connections."""
+    result = run_backup()
+    if result and result['status'] != 'ok':
+        raise RuntimeError(result['error'])
+
+# --- Run Statistics ---
+
+def record_run(name, duration_ms, error=None):
+    """Adds one run of a task to its statistics."""
+    try:
+        db.execute(
+            '''INSERT INTO maintenance_runs
+                   (name, runs, failures, last_run, last_duration_ms, total_duration_ms, last_error)
+               VALUES (?, 1, ?, ?, ?, ?, ?)
+               ON CONFLICT (name) DO UPDATE SET
+                   runs = runs + 1, failures = failures + excluded.failures,
+                   last_run = excluded.last_run, last_duration_ms = excluded.last_duration_ms,
+                   total_duration_ms = total_duration_ms + excluded.total_duration_ms,
+                   last_error = excluded.last_error''',
+            (name, 1 if error else 0, time.time(), round(duration_ms, 2), round(duration_ms, 2), error),
+            commit=True
+        )
+    except sqlite3.Error as e:
+        logger.warning(f"Could not record maintenance run of {name}: {e}")
+
+def run_stats():
+    """Run statistics of every task, from whichever process ran it."""
+    rows = db.execute(
+        '''SELECT name, runs, failures, last_run, last_duration_ms, total_duration_ms, last_error
+           FROM maintenance_runs ORDER BY name''', fetchall=True
+    )
+    return {name: {'runs': runs, 'failures': failures, 'last_run': last_run,
+                   'last_duration_ms': last_duration_ms, 'total_duration_ms': round(total_duration_ms, 2),
+                   'last_error': last_error}
+            for name, runs, failures, last_run, last_duration_ms, total_duration_ms, last_error in rows}
+
+# --- Scheduler ---
+
+class MaintenanceScheduler:
+    """Runs periodic database tasks on a background thread.
+
+    Each task gets its own short-timeout connection so it gives up rather
+    than blocking writers, and waits for a lull in API traffic before it
+    starts. A task may return the number of seconds until its next run to
+    override its interval. Run statistics are kept in the `maintenance_runs`
+    table, so the web app can show them for a standalone scheduler too.
+    """
+
+    def __init__(self, idle_seconds=MAINTENANCE_IDLE_MS / 1000, max_defer=MAINTENANCE_MAX_DEFER):
+        self.idle_seconds = idle_seconds
+        self.max_defer = max_defer
+        self.tasks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def add_task(self, name, func, interval, run_now=False):
+        next_run = time.monotonic() + (0 if run_now else interval)
+        self.tasks[name] = {'func': func, 'interval': interval, 'next_run': next_run}
+
+    def run_task(self, name):
+        task = self.tasks[name]
+        started = time.perf_counter()
+        next_interval = None
+        error = None
+        try:
+            conn = sqlite3.connect(db.db_name, timeout=1)
+            try:
+                next_interval = task['func'](conn)
+                conn.commit()
+            finally:
+                conn.close()
+        except Exception as e:
+            error = str(e)
+            logger.warning(f"Maintenance task {name} failed: {e}")
+        duration_ms = (time.perf_counter() - started) * 1000
+        record_run(name, duration_ms, error)
+        logger.info(f"Maintenance task {name} took {duration_ms:.1f} ms")
+        task['next_run'] = time.monotonic() + (next_interval or task['interval'])
+
+    def run_pending(self):
+        """Runs every task that is due. Returns seconds until the next one."""
+        for name, task in self.tasks.items():
+            if self._stop.is_set():
+                break
+            if task['next_run'] <= time.monotonic():
+                activity.wait_idle(self.idle_seconds, self.max_defer, self._stop)
+                if not self._stop.is_set():
+                    self.run_task(name)
+        if not self.tasks:
+            return None
+        return max(0, min(t['next_run'] for t in self.tasks.values()) - time.monotonic())
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            wait = self.run_pending()
+            self._stop.wait(wait if wait is not None else 60)
+
+    def start(self):
+        if self._thread and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run_forever, name='db-maintenance', daemon=True)
+        self._thread.start()
+        logger.info("Database maintenance scheduler started.")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+
+def create_scheduler():
+    """Builds a scheduler with the standard maintenance tasks."""
+    scheduler = MaintenanceScheduler()
+    scheduler.add_task('wal_checkpoint', checkpoint_wal, WAL_CHECKPOINT_MAX_INTERVAL, run_now=True)
+    scheduler.add_task('optimize', optimize, OPTIMIZE_INTERVAL)
+    scheduler.add_task('incremental_vacuum', incremental_vacuum, VACUUM_INTERVAL)
+    scheduler.add_task('analyze', analyze, ANALYZE_INTERVAL)
+    scheduler.add_task('prune_changes', prune_changes, CHANGES_PRUNE_INTERVAL)
+    if BACKUP_INTERVAL:
+        scheduler.add_task('backup', backup, BACKUP_INTERVAL)
+    return scheduler
+
+scheduler = create_scheduler()
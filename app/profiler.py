@@ -0,0 +1,202 @@
+import asyncio
+import hmac
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+from functools import wraps
+
+from app.database import db, TimedCursor
+from app.config import (
+    PROFILER_ENABLED, PROFILER_SAMPLE_RATE, PROFILER_INTERVAL_MS, PROFILER_TOKEN, PROFILE_DIR
+)
+
+logger = logging.getLogger(__name__)
+
+# Changed at runtime through /api/admin/profiler
+settings = {
+    'enabled': PROFILER_ENABLED,
+    'sample_rate': PROFILER_SAMPLE_RATE,
+    'interval_ms': PROFILER_INTERVAL_MS,
+}
+
+_lock = threading.Lock()
+_sessions = {}
+_sampler = None
+
+class Session:
+    """Samples collected for one request or bot update, keyed by collapsed stack.
+
+    A session samples either a thread (Flask requests) or, when `task` is
+    set, one asyncio task running on that thread (bot handlers).
+    """
+
+    def __init__(self, kind, name, thread_id, task=None):
+        self.kind = kind
+        self.name = name
+        self.thread_id = thread_id
+        self.task = task
+        self.key = task if task is not None else thread_id
+        self.started = time.perf_counter()
+        self.samples = Counter()
+        self.db_time = defaultdict(float)
+
+# --- Decisions ---
+
+def should_sample():
+    """Picks a random fraction of requests/updates while profiling is switched on."""
+    return settings['enabled'] and random.random() < settings['sample_rate']
+
+def should_profile(header_value):
+    """Profiles sampled requests, and any request carrying the profiler token header."""
+    if header_value and PROFILER_TOKEN and hmac.compare_digest(header_value.encode(), PROFILER_TOKEN.encode()):
+        return True
+    return should_sample()
+
+# --- Sampling ---
+
+_execute_codes = (TimedCursor.execute.__code__, TimedCursor.executemany.__code__)
+
+def _sql_frame(query):
+    return 'sql:' + re.sub(r'\s+', ' ', query).strip().replace(';', ',')[:120]
+
+def _frame_names(frame, stop=None):
+    """Names of `frame` and its callers up to (not including) `stop`, outermost first."""
+    stack = []
+    while frame is not None and frame is not stop:
+        code = frame.f_code
+        if code in _execute_codes:
+            # Attribute time spent in the DB to the query being run
+            stack.append(_sql_frame(frame.f_locals.get('query', '?')))
+        stack.append(f"{frame.f_globals.get('__name__', '?')}.{getattr(code, 'co_qualname', code.co_name)}")
+        frame = frame.f_back
+    stack.reverse()
+    return stack
+
+def _collapse(frame):
+    return ';'.join(_frame_names(frame))
+
+def _collapse_task(task, thread_frame):
+    """Collapses the await chain of a task.
+
+    The event loop thread's own stack only shows the task while it runs, so
+    the chain is read from the coroutines: a suspended one points to what it
+    awaits through `cr_await`, ending in the future it waits on. The running
+    one is completed from `thread_frame`.
+    """
+    stack = []
+    awaitable = task.get_coro()
+    while awaitable is not None:
+        frame = getattr(awaitable, 'cr_frame', None) or getattr(awaitable, 'gi_frame', None)
+        if frame is None:
+            stack.append(f'await:{type(awaitable).__name__}')
+            break
+        stack.extend(_frame_names(frame, frame.f_back))
+        awaited = getattr(awaitable, 'cr_await', None) or getattr(awaitable, 'gi_yieldfrom', None)
+        if awaited is None:
+            if getattr(awaitable, 'cr_running', False) or getattr(awaitable, 'gi_running', False):
+                stack.extend(_frame_names(thread_frame, frame))
+            break
+        awaitable = awaited
+    return ';'.join(stack)
+
+def _sample_loop():
+    global _sampler
+    while True:
+        time.sleep(settings['interval_ms'] / 1000)
+        with _lock:
+            if not _sessions:
+                _sampler = None
+                return
+            sessions = list(_sessions.values())
+        frames = sys._current_frames()
+        for session in sessions:
+            frame = frames.get(session.thread_id)
+            if session.task is not None:
+                stack = _collapse_task(session.task, frame)
+                if stack:
+                    session.samples[stack] += 1
+            elif frame is not None:
+                session.samples[_collapse(frame)] += 1
+
+def _current_task():
+    try:
+        return asyncio.current_task()
+    except RuntimeError:  # No event loop running in this thread
+        return None
+
+def _record_query(query, seconds):
+    session = _sessions.get(threading.get_ident()) or _sessions.get(_current_task())
+    if session is not None:
+        session.db_time[_sql_frame(query)] += seconds
+
+# --- Sessions ---
+
+def start_session(kind, name, task=None):
+    """Starts sampling the current thread, or `task` on it.
+
+    Returns None if it is already being sampled.
+    """
+    global _sampler
+    session = Session(kind, name, threading.get_ident(), task)
+    with _lock:
+        if session.key in _sessions:
+            return None
+        _sessions[session.key] = session
+        db.query_hook = _record_query
+        if _sampler is None:
+            _sampler = threading.Thread(target=_sample_loop, name='profiler', daemon=True)
+            _sampler.start()
+    return session
+
+def stop_session(session):
+    """Stops sampling and writes the session's collapsed stacks to PROFILE_DIR."""
+    with _lock:
+        _sessions.pop(session.key, None)
+        if not _sessions:
+            db.query_hook = None
+    elapsed_ms = (time.perf_counter() - session.started) * 1000
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        safe_name = re.sub(r'[^\w.-]', '_', session.name)
+        base = os.path.join(PROFILE_DIR, f"{datetime.now():%Y%m%d-%H%M%S-%f}-{session.kind}-{safe_name}")
+        with open(base + '.folded', 'w') as f:
+            for stack, count in session.samples.items():
+                f.write(f"{stack} {count}\n")
+        if session.db_time:
+            # Exact DB time per query, in microseconds, as a second flame graph
+            with open(base + '.db.folded', 'w') as f:
+                for query, seconds in session.db_time.items():
+                    f.write(f"{session.name};{query} {round(seconds * 1_000_000)}\n")
+        logger.info(f"Profiled {session.kind} {session.name}: {elapsed_ms:.1f} ms, "
+                    f"{sum(session.samples.values())} samples -> {base}.folded")
+    except OSError as e:
+        logger.error(f"Could not write profile for {session.name}: {e}")
+
+def list_profiles(limit=50):
+    """Lists the newest profile files."""
+    if not os.path.isdir(PROFILE_DIR):
+        return []
+    names = sorted((n for n in os.listdir(PROFILE_DIR) if n.endswith('.folded')), reverse=True)
+    return names[:limit]
+
+def profiled(callback):
+    """Profiles a sampled fraction of the bot updates handled by `callback`.
+
+    Samples follow the handler's task rather than the event loop thread,
+    so time spent awaiting Telegram shows up under the awaiting call.
+    """
+    @wraps(callback)
+    async def wrapper(update, context):
+        session = start_session('bot', callback.__name__, asyncio.current_task()) if should_sample() else None
+        try:
+            return await callback(update, context)
+        finally:
+            if session:
+                stop_session(session)
+    return wrapper
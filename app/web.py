@@ -1,5 +1,6 @@
-from flask import Flask, request, jsonify, g
+from flask import Flask, request, jsonify, g, send_file, send_from_directory
 from flask_cors import CORS
+from werkzeug.exceptions import HTTPException
 from datetime import datetime
 import logging
 import hmac
@@ -10,10 +11,18 @@ from functools import wraps
 from urllib.parse import parse_qsl
 
 # Import centralized modules
-from app.database import db, get_setting, update_setting, init_default_settings
+from app.database import (
+    db, get_setting, update_setting, init_default_settings, read_entitlement, consume_slot,
+    release_slot, init_wishlist_entitlement, delete_wishlist_entitlement
+)
 from app.config import (
-    BOT_TOKEN, ADMIN_USER_ID, ENABLE_VALIDATION, DEFAULT_SETTINGS, DEBUG, PORT
+    BOT_TOKEN, ADMIN_USER_ID, ENABLE_VALIDATION, DEFAULT_SETTINGS, DEBUG, PORT, PROFILE_DIR, IMAGE_MAX_AGE
 )
+from app.maintenance import activity, run_stats as maintenance_run_stats
+from app import backup
+from app.images import ImageError, image_key, register_images, backfill_images, get_image
+from app.changes import record_change, notify, changes_page, event_stream
+from app import profiler
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
@@ -27,10 +36,37 @@ logger = logging.getLogger(__name__)
 # Initialize default settings in the database on startup
 with app.app_context():
     init_default_settings(DEFAULT_SETTINGS)
+    backfill_images()
 
 if not BOT_TOKEN and ENABLE_VALIDATION:
     logger.warning("BOT_TOKEN is not set. Telegram data validation will be disabled.")
 
+# Let background database maintenance wait for gaps in API traffic.
+# Event streams stay open for minutes and are not counted as traffic.
+STREAMING_ENDPOINTS = {'user_events', 'public_wishlist_events'}
+
+@app.before_request
+def track_request_start():
+    if request.endpoint not in STREAMING_ENDPOINTS:
+        request.environ['iwish.tracked'] = True
+        activity.enter()
+
+@app.teardown_request
+def track_request_end(exc):
+    if request.environ.pop('iwish.tracked', False):
+        activity.leave()
+
+@app.before_request
+def start_profiling():
+    if request.endpoint not in STREAMING_ENDPOINTS and profiler.should_profile(request.headers.get('X-Profile')):
+        request.environ['iwish.profile'] = profiler.start_session('http', request.endpoint or 'unknown')
+
+@app.teardown_request
+def stop_profiling(exc):
+    session = request.environ.pop('iwish.profile', None)
+    if session:
+        profiler.stop_session(session)
+
 # --- Authentication & User Handling ---
 
 def validate_telegram_data(init_data: str) -> bool:
@@ -58,12 +94,18 @@ def login_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
         init_data = request.headers.get('X-Telegram-Init-Data')
+        if not init_data and request.endpoint in STREAMING_ENDPOINTS:
+            # EventSource cannot send headers, so event streams also take the signed data as ?init_data=
+            init_data = request.args.get('init_data')
         if not init_data:
             return jsonify({'error': 'Unauthorized', 'message': 'X-Telegram-Init-Data header is missing.'}), 401
 
-        if ENABLE_VALIDATION and not validate_telegram_data(init_data):
-            logger.warning("Invalid Telegram data received.")
-            return jsonify({'error': 'Unauthorized', 'message': 'Invalid Telegram data.'}), 401
+        # Sub-requests of /api/batch share `g` with the batch request, so validate only once
+        if ENABLE_VALIDATION and g.get('validated_init_data') != init_data:
+            if not validate_telegram_data(init_data):
+                logger.warning("Invalid Telegram data received.")
+                return jsonify({'error': 'Unauthorized', 'message': 'Invalid Telegram data.'}), 401
+            g.validated_init_data = init_data
         
         try:
             user_str = dict(parse_qsl(init_data)).get('user', '{}')
@@ -101,6 +143,54 @@ def admin_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
+# --- Queries ---
+# Shared by the single-resource routes and /api/bootstrap; each takes a cursor
+# so several of them can run inside one read transaction.
+
+def fetch_user(c, user_id):
+    c.execute('SELECT user_id, username, first_name FROM users WHERE user_id = ?', (user_id,))
+    user = c.fetchone()
+    if user:
+        return {'user_id': user[0], 'username': user[1], 'first_name': user[2]}
+    return None
+
+def fetch_wishlists(c, user_id):
+    c.execute(
+        '''SELECT w.id, w.name, w.is_free, w.created_at, COUNT(i.id) FROM wishlists w
+           LEFT JOIN items i ON i.wishlist_id = w.id
+           WHERE w.user_id = ? GROUP BY w.id ORDER BY w.created_at DESC''',
+        (user_id,)
+    )
+    return [{
+        'id': wl_id, 'name': name, 'is_free': bool(is_free),
+        'item_count': item_count, 'created_at': created_at
+    } for wl_id, name, is_free, created_at, item_count in c.fetchall()]
+
+def fetch_pricing(c, user_id):
+    c.execute('SELECT key, value FROM settings')
+    settings = dict(c.fetchall())
+    # Reads only, so it stays inside the caller's read transaction
+    free_slots, paid_slots = read_entitlement(c, user_id)
+    pricing = {key: int(settings.get(key, default)) for key, default in DEFAULT_SETTINGS.items()}
+    pricing['has_free_wishlist'] = free_slots > 0
+    pricing['paid_wishlist_slots'] = paid_slots
+    return pricing
+
+def image_urls(image_url):
+    """Proxy URLs for an item image, served from the local image cache."""
+    if not image_url:
+        return {'image_proxy_url': '', 'image_thumb_url': ''}
+    key = image_key(image_url)
+    return {'image_proxy_url': f'/api/img/{key}', 'image_thumb_url': f'/api/img/{key}?size=thumb'}
+
+def serialize_item(item):
+    """Converts an `(id, title, description, url, image_url, created_at)` row to JSON."""
+    return {
+        'id': item[0], 'title': item[1], 'description': item[2] or '',
+        'url': item[3] or '', 'image_url': item[4] or '', 'created_at': item[5],
+        **image_urls(item[4])
+    }
+
 # --- API Routes ---
 
 @app.route('/api/health', methods=['GET'])
@@ -112,29 +202,18 @@ def health():
 @login_required
 def get_user():
     """Gets information about the current user."""
-    user = db.execute('SELECT user_id, username, first_name FROM users WHERE user_id = ?', (g.user_id,), fetchone=True)
+    with db.read_transaction() as c:
+        user = fetch_user(c, g.user_id)
     if user:
-        return jsonify({'user_id': user[0], 'username': user[1], 'first_name': user[2]})
+        return jsonify(user)
     return jsonify({'error': 'User not found'}), 404
 
 @app.route('/api/wishlists', methods=['GET'])
 @login_required
 def get_wishlists():
     """Gets all wishlists for the current user."""
-    wishlists_data = db.execute(
-        '''SELECT id, name, is_free, created_at FROM wishlists
-           WHERE user_id = ? ORDER BY created_at DESC''',
-        (g.user_id,), fetchall=True
-    )
-    
-    result = []
-    for wl_id, name, is_free, created_at in wishlists_data:
-        item_count = db.execute('SELECT COUNT(*) FROM items WHERE wishlist_id = ?', (wl_id,), fetchone=True)[0]
-        result.append({
-            'id': wl_id, 'name': name, 'is_free': bool(is_free),
-            'item_count': item_count, 'created_at': created_at
-        })
-    return jsonify(result)
+    with db.read_transaction() as c:
+        return jsonify(fetch_wishlists(c, g.user_id))
 
 @app.route('/api/wishlists', methods=['POST'])
 @login_required
@@ -153,19 +232,25 @@ def create_wishlist():
         commit=True
     )
 
-    wishlist_count = db.execute('SELECT COUNT(*) FROM wishlists WHERE user_id = ?', (g.user_id,), fetchone=True)[0]
-    is_free = wishlist_count == 0
-    
-    wishlist_id = db.execute(
-        '''INSERT INTO wishlists (user_id, name, is_free, created_at)
-           VALUES (?, ?, ?, ?)''',
-        (g.user_id, name, 1 if is_free else 0, datetime.now()),
-        commit=True
-    )
+    created_at = datetime.now()
+    with db.get_connection() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        is_free = consume_slot(c, g.user_id) == 'free'
+        c.execute(
+            '''INSERT INTO wishlists (user_id, name, is_free, created_at)
+               VALUES (?, ?, ?, ?)''',
+            (g.user_id, name, 1 if is_free else 0, created_at)
+        )
+        wishlist = {
+            'id': c.lastrowid, 'name': name, 'is_free': is_free, 'item_count': 0, 'created_at': str(created_at)
+        }
+        init_wishlist_entitlement(c, g.user_id, wishlist['id'])
+        record_change(c, g.user_id, wishlist['id'], 'wishlist_added', wishlist['id'], wishlist)
+        conn.commit()
+    notify()
     
-    return jsonify({
-        'id': wishlist_id, 'name': name, 'is_free': is_free, 'item_count': 0
-    }), 201
+    return jsonify(wishlist), 201
 
 @app.route('/api/wishlists/<int:wishlist_id>', methods=['GET'])
 @login_required
@@ -181,10 +266,7 @@ def get_wishlist(wishlist_id):
         'SELECT id, title, description, url, image_url, created_at FROM items WHERE wishlist_id = ? ORDER BY created_at DESC',
         (wishlist_id,), fetchall=True
     )
-    items = [{
-        'id': item[0], 'title': item[1], 'description': item[2] or '',
-        'url': item[3] or '', 'image_url': item[4] or '', 'created_at': item[5]
-    } for item in items_data]
+    items = [serialize_item(item) for item in items_data]
     
     return jsonify({'id': wishlist[0], 'name': wishlist[1], 'items': items})
 
@@ -192,14 +274,22 @@ def get_wishlist(wishlist_id):
 @login_required
 def delete_wishlist(wishlist_id):
     """Deletes a wishlist."""
-    wishlist = db.execute('SELECT user_id FROM wishlists WHERE id = ?', (wishlist_id,), fetchone=True)
+    wishlist = db.execute('SELECT user_id, is_free FROM wishlists WHERE id = ?', (wishlist_id,), fetchone=True)
     if not wishlist:
         return jsonify({'error': 'Wishlist not found'}), 404
     if wishlist[0] != g.user_id:
         return jsonify({'error': 'Forbidden'}), 403
     
-    db.execute('DELETE FROM items WHERE wishlist_id = ?', (wishlist_id,), commit=True)
-    db.execute('DELETE FROM wishlists WHERE id = ?', (wishlist_id,), commit=True)
+    with db.get_connection() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('DELETE FROM items WHERE wishlist_id = ?', (wishlist_id,))
+        c.execute('DELETE FROM wishlists WHERE id = ?', (wishlist_id,))
+        delete_wishlist_entitlement(c, g.user_id, wishlist_id)
+        release_slot(c, g.user_id, 0, wishlist[1])
+        record_change(c, g.user_id, wishlist_id, 'wishlist_deleted', wishlist_id)
+        conn.commit()
+    notify()
     
     return jsonify({'success': True})
 
@@ -218,26 +308,30 @@ def add_item(wishlist_id):
     if not title:
         return jsonify({'error': 'Title is required'}), 400
 
-    item_count = db.execute('SELECT COUNT(*) FROM items WHERE wishlist_id = ?', (wishlist_id,), fetchone=True)[0]
-    wishlist_count = db.execute('SELECT COUNT(*) FROM wishlists WHERE user_id = ?', (g.user_id,), fetchone=True)[0]
-    free_items_limit = get_setting('free_wishlist_items', DEFAULT_SETTINGS['free_wishlist_items'])
-    
-    is_free = wishlist_count == 1 and item_count < free_items_limit
-    
-    item_id = db.execute(
-        '''INSERT INTO items (wishlist_id, title, description, url, image_url, is_free, created_at)
-           VALUES (?, ?, ?, ?, ?, ?, ?)''',
-        (
-            wishlist_id, title[:100], data.get('description', '')[:500] or '',
-            data.get('url') or None, data.get('image_url') or None,
-            1 if is_free else 0, datetime.now()
-        ),
-        commit=True
-    )
+    description = data.get('description', '')[:500] or ''
+    url = data.get('url') or None
+    image_url = data.get('image_url') or None
+    created_at = datetime.now()
+    with db.get_connection() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        is_free = consume_slot(c, g.user_id, wishlist_id) == 'free'
+        c.execute(
+            '''INSERT INTO items (wishlist_id, title, description, url, image_url, is_free, created_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (wishlist_id, title[:100], description, url, image_url, 1 if is_free else 0, created_at)
+        )
+        item_id = c.lastrowid
+        item = serialize_item((item_id, title[:100], description, url, image_url, str(created_at)))
+        record_change(c, g.user_id, wishlist_id, 'item_added', item_id, item)
+        conn.commit()
+    notify()
+    register_images([data.get('image_url')])
     
     return jsonify({
         'id': item_id, 'title': title, 'description': data.get('description', ''),
-        'url': data.get('url', ''), 'image_url': data.get('image_url', '')
+        'url': data.get('url', ''), 'image_url': data.get('image_url', ''),
+        **image_urls(data.get('image_url'))
     }), 201
 
 @app.route('/api/items/<int:item_id>', methods=['DELETE'])
@@ -245,7 +339,7 @@ def add_item(wishlist_id):
 def delete_item(item_id):
     """Deletes an item."""
     item = db.execute(
-        'SELECT w.user_id FROM items i JOIN wishlists w ON i.wishlist_id = w.id WHERE i.id = ?',
+        'SELECT w.user_id, i.wishlist_id, i.is_free FROM items i JOIN wishlists w ON i.wishlist_id = w.id WHERE i.id = ?',
         (item_id,), fetchone=True
     )
     if not item:
@@ -253,21 +347,95 @@ def delete_item(item_id):
     if item[0] != g.user_id:
         return jsonify({'error': 'Forbidden'}), 403
         
-    db.execute('DELETE FROM items WHERE id = ?', (item_id,), commit=True)
+    with db.get_connection() as conn:
+        c = conn.cursor()
+        c.execute('BEGIN IMMEDIATE')
+        c.execute('DELETE FROM items WHERE id = ?', (item_id,))
+        release_slot(c, g.user_id, item[1], item[2])
+        record_change(c, g.user_id, item[1], 'item_deleted', item_id)
+        conn.commit()
+    notify()
     return jsonify({'success': True})
 
 @app.route('/api/pricing', methods=['GET'])
 @login_required
 def get_pricing():
     """Gets pricing information."""
-    wishlist_count = db.execute('SELECT COUNT(*) FROM wishlists WHERE user_id = ?', (g.user_id,), fetchone=True)[0]
-    
-    return jsonify({
-        'free_wishlist_items': get_setting('free_wishlist_items', DEFAULT_SETTINGS['free_wishlist_items']),
-        'new_wishlist_price': get_setting('new_wishlist_price', DEFAULT_SETTINGS['new_wishlist_price']),
-        'new_item_price': get_setting('new_item_price', DEFAULT_SETTINGS['new_item_price']),
-        'has_free_wishlist': wishlist_count == 0
-    })
+    with db.read_transaction() as c:
+        return jsonify(fetch_pricing(c, g.user_id))
+
+@app.route('/api/changes', methods=['GET'])
+@login_required
+def get_changes():
+    """Gets the current user's changes after the `since` sequence number."""
+    return jsonify(changes_page(request.args.get('since', 0, type=int), user_id=g.user_id))
+
+@app.route('/api/events', methods=['GET'])
+@login_required
+def user_events():
+    """Streams the current user's changes as server-sent events."""
+    since = request.headers.get('Last-Event-ID', request.args.get('since', 0, type=int), type=int)
+    return event_stream(since, user_id=g.user_id)
+
+@app.route('/api/bootstrap', methods=['GET'])
+@login_required
+def bootstrap():
+    """Gets everything the Mini App's first screen needs in one read transaction."""
+    with db.read_transaction() as c:
+        return jsonify({
+            'user': fetch_user(c, g.user_id),
+            'wishlists': fetch_wishlists(c, g.user_id),
+            'pricing': fetch_pricing(c, g.user_id),
+            # Where to start /api/events so the stream picks up right after this snapshot
+            'seq': c.execute('SELECT COALESCE(MAX(seq), 0) FROM changes WHERE user_id = ?',
+                             (g.user_id,)).fetchone()[0]
+        })
+
+BATCH_MAX_REQUESTS = 10
+# Endpoints whose responses are not a single JSON document
+BATCH_EXCLUDED_ENDPOINTS = STREAMING_ENDPOINTS | {'batch', 'get_item_image', 'get_admin_profile'}
+
+@app.route('/api/batch', methods=['POST'])
+@login_required
+def batch():
+    """Runs several GET API requests in one round trip.
+
+    Expects `{"requests": [{"path": "/api/..."}, ...]}` and returns the
+    status and JSON body of each sub-request in order.
+    """
+    data = request.json or {}
+    subrequests = data.get('requests')
+    if not isinstance(subrequests, list) or not subrequests:
+        return jsonify({'error': 'requests must be a non-empty list'}), 400
+    if len(subrequests) > BATCH_MAX_REQUESTS:
+        return jsonify({'error': f'At most {BATCH_MAX_REQUESTS} requests per batch'}), 400
+
+    headers = {'X-Telegram-Init-Data': request.headers.get('X-Telegram-Init-Data')}
+    url_adapter = app.create_url_adapter(request)
+    responses = []
+    for sub in subrequests:
+        path = sub.get('path') if isinstance(sub, dict) else None
+        if not isinstance(path, str) or not path.startswith('/api/'):
+            responses.append({'path': path, 'status': 400, 'body': {'error': 'Invalid path'}})
+            continue
+        try:
+            endpoint, _ = url_adapter.match(path.split('?')[0], method='GET')
+        except HTTPException as e:
+            responses.append({'path': path, 'status': e.code, 'body': {'error': e.name}})
+            continue
+        if endpoint in BATCH_EXCLUDED_ENDPOINTS:
+            responses.append({'path': path, 'status': 400, 'body': {'error': 'Endpoint cannot be batched'}})
+            continue
+        try:
+            with app.test_request_context(path, method='GET', headers=headers):
+                response = app.full_dispatch_request()
+        except Exception as e:
+            logger.error(f"Batch sub-request {path} failed: {e}", exc_info=True)
+            responses.append({'path': path, 'status': 500, 'body': {'error': 'Internal server error'}})
+            continue
+        responses.append({'path': path, 'status': response.status_code, 'body': response.get_json(silent=True)})
+        response.close()
+    return jsonify({'responses': responses})
 
 # --- Public Routes (for inline mode, etc.) ---
 
@@ -286,16 +454,46 @@ def get_public_wishlist(wishlist_id):
         'SELECT id, title, description, url, image_url, created_at FROM items WHERE wishlist_id = ? ORDER BY created_at DESC',
         (wishlist_id,), fetchall=True
     )
-    items = [{
-        'id': item[0], 'title': item[1], 'description': item[2] or '',
-        'url': item[3] or '', 'image_url': item[4] or '', 'created_at': item[5]
-    } for item in items_data]
+    items = [serialize_item(item) for item in items_data]
     
     return jsonify({
         'id': wishlist[0], 'name': wishlist[1], 'user_id': wishlist[2],
         'user_name': wishlist[3], 'user_username': wishlist[4], 'items': items
     })
 
+@app.route('/api/public/wishlist/<int:wishlist_id>/changes', methods=['GET'])
+def get_public_wishlist_changes(wishlist_id):
+    """Gets the changes to a wishlist after the `since` sequence number."""
+    return jsonify(changes_page(request.args.get('since', 0, type=int), wishlist_id=wishlist_id))
+
+@app.route('/api/public/wishlist/<int:wishlist_id>/events', methods=['GET'])
+def public_wishlist_events(wishlist_id):
+    """Streams changes to a wishlist as server-sent events."""
+    if not db.execute('SELECT 1 FROM wishlists WHERE id = ?', (wishlist_id,), fetchone=True):
+        return jsonify({'error': 'Wishlist not found'}), 404
+    since = request.headers.get('Last-Event-ID', request.args.get('since', 0, type=int), type=int)
+    return event_stream(since, wishlist_id=wishlist_id)
+
+@app.route('/api/img/<key>', methods=['GET'])
+def get_item_image(key):
+    """Serves an item image (or its thumbnail with `?size=thumb`) from the image cache."""
+    try:
+        image = get_image(key, thumb=request.args.get('size') == 'thumb')
+    except ImageError as e:
+        logger.warning(f"Image proxy error: {e}")
+        return jsonify({'error': 'Image unavailable'}), 502
+    if not image:
+        return jsonify({'error': 'Image not found'}), 404
+
+    path, content_type, etag = image
+    # A key names the source URL, whose bytes may change when it is fetched again
+    # after eviction, so clients revalidate by ETag (the content hash) instead
+    response = send_file(path, mimetype=content_type, etag=etag, conditional=True, max_age=IMAGE_MAX_AGE)
+    response.cache_control.public = True
+    response.headers['X-Content-Type-Options'] = 'nosniff'
+    response.headers['Content-Security-Policy'] = "default-src 'none'"
+    return response
+
 # ... (other public routes can be refactored similarly)
 
 # --- Admin Routes ---
@@ -347,6 +545,66 @@ def get_admin_stats():
     }
     return jsonify(stats)
 
+@app.route('/api/admin/maintenance', methods=['GET'])
+@admin_required
+def get_admin_maintenance():
+    """Gets run statistics of the database maintenance tasks."""
+    return jsonify(maintenance_run_stats())
+
+@app.route('/api/admin/backups', methods=['GET'])
+@admin_required
+def get_admin_backups():
+    """Lists database backups and the result of the last run."""
+    return jsonify({
+        'running': backup.is_running(),
+        'last': backup.last_backup,
+        'backups': backup.list_backups()
+    })
+
+@app.route('/api/admin/backups', methods=['POST'])
+@admin_required
+def create_admin_backup():
+    """Starts an online database backup in the background."""
+    if not backup.start_backup():
+        return jsonify({'error': 'Backup already running'}), 409
+    return jsonify({'status': 'started'}), 202
+
+@app.route('/api/admin/profiler', methods=['GET'])
+@admin_required
+def get_admin_profiler():
+    """Gets the profiler settings and the newest profile files."""
+    return jsonify({'settings': profiler.settings, 'profiles': profiler.list_profiles()})
+
+@app.route('/api/admin/profiler', methods=['POST'])
+@admin_required
+def update_admin_profiler():
+    """Switches the sampling profiler on or off and tunes it."""
+    data = request.json
+    if not data:
+        return jsonify({'error': 'No data provided'}), 400
+    try:
+        if 'sample_rate' in data:
+            sample_rate = float(data['sample_rate'])
+            if not 0 <= sample_rate <= 1:
+                return jsonify({'error': 'sample_rate must be between 0 and 1'}), 400
+            profiler.settings['sample_rate'] = sample_rate
+        if 'interval_ms' in data:
+            interval_ms = float(data['interval_ms'])
+            if interval_ms < 1:
+                return jsonify({'error': 'interval_ms must be at least 1'}), 400
+            profiler.settings['interval_ms'] = interval_ms
+    except (TypeError, ValueError):
+        return jsonify({'error': 'sample_rate and interval_ms must be numbers'}), 400
+    if 'enabled' in data:
+        profiler.settings['enabled'] = bool(data['enabled'])
+    return jsonify({'success': True, 'settings': profiler.settings})
+
+@app.route('/api/admin/profiler/<path:name>', methods=['GET'])
+@admin_required
+def get_admin_profile(name):
+    """Downloads a collapsed-stack profile file."""
+    return send_from_directory(os.path.abspath(PROFILE_DIR), name, mimetype='text/plain', as_attachment=True)
+
 from telegram import Update
 from bot.main import application
 
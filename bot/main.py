@@ -10,6 +10,7 @@ from telegram.ext import (
 from telegram.constants import ParseMode
 from uuid import uuid4
 from datetime import datetime
+import asyncio
 import sys
 import os
 
@@ -17,10 +18,13 @@ import os
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
 # Import centralized modules
-from app.database import db, get_setting
+from app.database import db, get_setting, get_entitlement, credit_payment, record_refund_due
 from app.config import (
-    BOT_TOKEN, DEFAULT_SETTINGS, SKIP_WORDS
+    BOT_TOKEN, DEFAULT_SETTINGS, SKIP_WORDS, TELEGRAM_API_URL, TELEGRAM_FILE_URL,
+    SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_MAX_RETRIES
 )
+from app.profiler import profiled
+from bot.sender import SendScheduler
 
 # --- Logging ---
 logging.basicConfig(
@@ -37,24 +41,32 @@ user_states = {}
 async def replace_with_new_message(query, context, *, text=None, photo=None,
                                    reply_markup=None, parse_mode=None,
                                    disable_web_page_preview=True):
-    """Deletes the current message and sends a new one."""
+    """Deletes the current message and sends a new one.
+
+    Both calls are independent, so they run concurrently instead of costing
+    two sequential round trips.
+    """
     chat_id = query.message.chat_id
-    try:
-        await query.message.delete()
-    except Exception as exc:
-        logger.debug(f"Could not delete message: {exc}")
 
     if photo:
-        return await context.bot.send_photo(
+        send = context.bot.send_photo(
             chat_id=chat_id, photo=photo, caption=text,
             parse_mode=parse_mode, reply_markup=reply_markup
         )
-    if text:
-        return await context.bot.send_message(
+    elif text:
+        send = context.bot.send_message(
             chat_id=chat_id, text=text, parse_mode=parse_mode,
             reply_markup=reply_markup, disable_web_page_preview=disable_web_page_preview
         )
-    raise ValueError("Text or photo must be provided.")
+    else:
+        raise ValueError("Text or photo must be provided.")
+
+    deleted, message = await asyncio.gather(query.message.delete(), send, return_exceptions=True)
+    if isinstance(deleted, Exception):
+        logger.debug(f"Could not delete message: {deleted}")
+    if isinstance(message, Exception):
+        raise message
+    return message
 
 # --- Command Handlers ---
 
@@ -176,26 +188,63 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 # --- Payment Handlers ---
 
+def payment_target(user_id, payload):
+    """Maps an invoice payload to the entitlement it buys: 0 for a wishlist, else a wishlist ID."""
+    if payload == "new_wishlist":
+        return 0
+    if payload.startswith("new_item_"):
+        try:
+            wishlist_id = int(payload.split('_')[-1])
+        except ValueError:
+            return None
+        owner = db.execute('SELECT user_id FROM wishlists WHERE id = ?', (wishlist_id,), fetchone=True)
+        if owner and owner[0] == user_id:
+            return wishlist_id
+    return None
+
 async def precheckout_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Answers pre-checkout queries."""
     query = update.pre_checkout_query
+    wishlist_id = payment_target(query.from_user.id, query.invoice_payload)
+    if wishlist_id is None:
+        await query.answer(ok=False, error_message="Вишлист не найден.")
+        return
+
+    free_slots, _ = get_entitlement(query.from_user.id, wishlist_id)
+    if free_slots > 0:
+        await query.answer(ok=False, error_message="У тебя ещё есть бесплатные места — оплата не нужна.")
+        return
     await query.answer(ok=True)
 
 async def successful_payment_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles successful payments."""
     user_id = update.effective_user.id
-    payload = update.message.successful_payment.invoice_payload
+    payment = update.message.successful_payment
+    payload = payment.invoice_payload
+
+    wishlist_id = payment_target(user_id, payload)
+    if wishlist_id is None:
+        # E.g. the wishlist was deleted between pre-checkout and payment: keep the charge for a refund
+        if record_refund_due(payment.telegram_payment_charge_id, user_id, payload, payment.total_amount):
+            logger.error(f"Payment {payment.telegram_payment_charge_id} for {payload} matched nothing, "
+                         f"marked for refund")
+            await update.message.reply_text(
+                "⚠️ Оплата получена, но вишлист не найден. Мы вернём деньги."
+            )
+        return
+    if not credit_payment(payment.telegram_payment_charge_id, user_id, wishlist_id, payload, payment.total_amount):
+        logger.info(f"Payment {payment.telegram_payment_charge_id} was already credited")
+        return
     
     if payload == "new_wishlist":
-        user_states[user_id] = {'action': 'creating_wishlist', 'is_free': False}
+        user_states[user_id] = {'action': 'creating_wishlist'}
         await update.message.reply_text(
             "💫 *Оплата прошла успешно!*\n\nТеперь введи название для нового вишлиста:",
             parse_mode=ParseMode.MARKDOWN
         )
-    elif payload.startswith("new_item_"):
-        wishlist_id = int(payload.split('_')[-1])
+    else:
         user_states[user_id] = {
-            'action': 'adding_item', 'wishlist_id': wishlist_id, 'is_free': False,
+            'action': 'adding_item', 'wishlist_id': wishlist_id,
             'step': 'awaiting_title', 'item_data': {}
         }
         await update.message.reply_text(
@@ -251,17 +300,27 @@ if not BOT_TOKEN:
     # For a serverless environment, this will cause the function to fail deployment or execution
     raise ValueError("BOT_TOKEN is not configured.")
 
-application = Application.builder().token(BOT_TOKEN).build()
-
-# Register handlers
-application.add_handler(CommandHandler("start", start))
-application.add_handler(CommandHandler("help", help_command))
-application.add_handler(CallbackQueryHandler(button_handler))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, message_handler))
-application.add_handler(MessageHandler(filters.PHOTO, message_handler))
-application.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback))
-application.add_handler(InlineQueryHandler(inline_query))
+application = (
+    Application.builder()
+    .token(BOT_TOKEN)
+    .base_url(TELEGRAM_API_URL)
+    .base_file_url(TELEGRAM_FILE_URL)
+    .rate_limiter(SendScheduler(
+        global_rate=SEND_GLOBAL_RATE, chat_rate=SEND_CHAT_RATE,
+        chat_burst=SEND_CHAT_BURST, max_retries=SEND_MAX_RETRIES
+    ))
+    .build()
+)
+
+# Register handlers (`profiled` samples a fraction of updates while the profiler is on)
+application.add_handler(CommandHandler("start", profiled(start)))
+application.add_handler(CommandHandler("help", profiled(help_command)))
+application.add_handler(CallbackQueryHandler(profiled(button_handler)))
+application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, profiled(message_handler)))
+application.add_handler(MessageHandler(filters.PHOTO, profiled(message_handler)))
+application.add_handler(PreCheckoutQueryHandler(profiled(precheckout_callback)))
+application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, profiled(successful_payment_callback)))
+application.add_handler(InlineQueryHandler(profiled(inline_query)))
 
 logger.info("Бот инициализирован!")
 
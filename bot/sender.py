@@ -0,0 +1,142 @@
+import asyncio
+import logging
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+class TokenBucket:
+    """A simple token bucket refilled continuously at `rate` tokens per second."""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self):
+        """Returns how many seconds to wait until a token is available."""
+        self._refill(time.monotonic())
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds):
+        """Empties the bucket so that the next token appears after `seconds`."""
+        self._refill(time.monotonic())
+        self.tokens = min(self.tokens, 1 - seconds * self.rate)
+
+    def is_full(self):
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+# Endpoints that post a message into a chat; only these count against the per-chat limit
+_CHAT_LIMITED_ENDPOINTS = {'copyMessage', 'copyMessages', 'forwardMessage', 'forwardMessages'}
+
+# Answers the user is waiting on: they take a global token but never queue for one
+_PRIORITY_ENDPOINTS = {'answerCallbackQuery', 'answerPreCheckoutQuery', 'answerInlineQuery'}
+
+def _is_chat_limited(endpoint):
+    return (endpoint.startswith('send') and endpoint != 'sendChatAction') or endpoint in _CHAT_LIMITED_ENDPOINTS
+
+class SendScheduler(BaseRateLimiter[int]):
+    """Paces outgoing Bot API calls with a global and a per-chat token bucket.
+
+    Only message-producing calls use the per-chat bucket; edits, deletions
+    and answers are paced globally. Answers to callback and pre-checkout
+    queries skip the queue, so they are not held up by broadcasts.
+    Calls for different chats (or within a chat's burst allowance) run
+    concurrently; everything else waits for a free token. `RetryAfter`
+    errors pause the affected chat (or the whole bot) and the call is retried.
+    The optional `rate_limit_args` of a bot method overrides `max_retries`.
+    """
+
+    def __init__(self, global_rate=30, chat_rate=1, chat_burst=3, max_retries=3, max_chats=10000):
+        self._global_rate = global_rate
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._max_retries = max_retries
+        self._max_chats = max_chats
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats = {}
+        self._lock = asyncio.Lock()
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        self._chats.clear()
+
+    def _chat_bucket(self, chat_id):
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) >= self._max_chats:
+                # Idle chats have refilled buckets and carry no state worth keeping
+                self._chats = {cid: b for cid, b in self._chats.items() if not b.is_full()}
+            bucket = self._chats[chat_id] = TokenBucket(self._chat_rate, self._chat_burst)
+        return bucket
+
+    async def _acquire(self, chat_id, priority=False):
+        while True:
+            async with self._lock:
+                chat_bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+                wait = max(self._global.delay(), chat_bucket.delay() if chat_bucket else 0)
+                if wait <= 0 or priority:
+                    # A priority call may overdraw the global bucket; queued calls wait a bit longer
+                    self._global.consume()
+                    if chat_bucket:
+                        chat_bucket.consume()
+                    return
+            await asyncio.sleep(wait)
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id') if _is_chat_limited(endpoint) else None
+        priority = endpoint in _PRIORITY_ENDPOINTS
+        max_retries = self._max_retries if rate_limit_args is None else rate_limit_args
+
+        for attempt in range(max_retries + 1):
+            await self._acquire(chat_id, priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as exc:
+                if attempt >= max_retries:
+                    raise
+                retry_after = exc.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logger.warning(f"Rate limited on {endpoint} (chat {chat_id}), retrying in {retry_after}s")
+                async with self._lock:
+                    if chat_id is not None:
+                        self._chat_bucket(chat_id).block(retry_after)
+                    else:
+                        self._global.block(retry_after)
+
+async def broadcast(bot, chat_ids, text, batch_size=25, **kwargs):
+    """Sends `text` to many chats in concurrent batches.
+
+    Pacing is left to the bot's rate limiter; a failed chat does not stop the
+    broadcast. Returns a `{chat_id: Message or exception}` mapping.
+    """
+    chat_ids = list(chat_ids)
+    results = {}
+    for start in range(0, len(chat_ids), batch_size):
+        batch = chat_ids[start:start + batch_size]
+        sent = await asyncio.gather(
+            *(bot.send_message(chat_id=chat_id, text=text, **kwargs) for chat_id in batch),
+            return_exceptions=True
+        )
+        for chat_id, result in zip(batch, sent):
+            if isinstance(result, Exception):
+                logger.warning(f"Broadcast to {chat_id} failed: {result}")
+            results[chat_id] = result
+    return results
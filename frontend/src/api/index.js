@@ -12,4 +12,10 @@ const api = axios.create({
   },
 });
 
+// EventSource cannot send headers, so the signed initData goes in the query string
+export const openUserEvents = (since = 0) => {
+  const params = new URLSearchParams({ since, init_data: WebApp.initData || '' });
+  return new EventSource(`${API_URL}/events?${params}`);
+};
+
 export default api;
@@ -21,7 +21,8 @@ const ItemCard = ({ item, onClick }) => {
         <CardMedia
           component="img"
           height="140"
-          image={item.image_url}
+          image={item.image_thumb_url || item.image_url}
+          loading="lazy"
           alt={item.title}
           sx={{ mb: 2, borderRadius: '8px' }}
         />
@@ -79,7 +79,7 @@ const ItemScreen = ({ itemId, wishlistId, onBack }) => {
       {item.image_url && (
         <CardMedia
           component="img"
-          image={item.image_url}
+          image={item.image_proxy_url || item.image_url}
           alt={item.title}
           sx={{ mb: 2, borderRadius: '8px', maxHeight: 400 }}
         />
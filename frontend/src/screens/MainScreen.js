@@ -3,7 +3,7 @@ import React, { useState, useEffect } from 'react';
 import { Container, Box, Typography, Button, CircularProgress } from '@mui/material';
 import AddIcon from '@mui/icons-material/Add';
 import WishlistCard from '../components/WishlistCard';
-import api from '../api';
+import api, { openUserEvents } from '../api';
 
 const MainScreen = ({ onWishlistClick, onCreateWishlist }) => {
   const [wishlists, setWishlists] = useState([]);
@@ -11,10 +11,25 @@ const MainScreen = ({ onWishlistClick, onCreateWishlist }) => {
   const [error, setError] = useState(null);
 
   useEffect(() => {
+    let events = null;
+    let closed = false;
+
     const fetchWishlists = async () => {
+      // One round trip for user, wishlists and pricing
+      const response = await api.get('/bootstrap');
+      setWishlists(response.data.wishlists);
+      return response.data.seq;
+    };
+
+    const start = async () => {
       try {
-        const response = await api.get('/wishlists');
-        setWishlists(response.data);
+        const seq = await fetchWishlists();
+        if (closed) return;
+        // Reload whenever a wishlist or item changes elsewhere (bot, another device)
+        events = openUserEvents(seq);
+        ['wishlist_added', 'wishlist_deleted', 'item_added', 'item_deleted', 'reset'].forEach((kind) =>
+          events.addEventListener(kind, () => fetchWishlists().catch(console.error))
+        );
       } catch (err) {
         setError('Failed to fetch wishlists.');
         console.error(err);
@@ -23,7 +38,11 @@ const MainScreen = ({ onWishlistClick, onCreateWishlist }) => {
       }
     };
 
-    fetchWishlists();
+    start();
+    return () => {
+      closed = true;
+      if (events) events.close();
+    };
   }, []);
 
   if (loading) {
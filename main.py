@@ -1,9 +1,43 @@
-import sys
+import argparse
+import logging
 import os
+import sys
 
 # Add the project root to the Python path
 sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
 
-# This file is the entry point for Vercel.
-# It provides the Flask app instance to the Vercel runtime.
-from app.web import app
+def serve():
+    """Runs the web server (and the bot webhook routes)."""
+    from app.web import app
+    from app.config import PORT, MAINTENANCE_ENABLED
+    if MAINTENANCE_ENABLED:
+        from app.maintenance import scheduler
+        scheduler.start()
+    # Never the Werkzeug debugger here: it allows code execution from the browser
+    app.run(host='0.0.0.0', port=PORT, debug=False, use_reloader=False)
+
+def maintenance(once=False):
+    """Runs the database maintenance tasks without the web app."""
+    from app.maintenance import scheduler
+    if once:
+        for name in scheduler.tasks:
+            scheduler.run_task(name)
+    else:
+        scheduler.run_forever()
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='iWishBot')
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('serve', help='Run the web app (default)')
+    maintenance_parser = subparsers.add_parser('maintenance', help='Run database maintenance')
+    maintenance_parser.add_argument('--once', action='store_true', help='Run every task once and exit')
+    args = parser.parse_args()
+
+    if args.command == 'maintenance':
+        maintenance(once=args.once)
+    else:
+        serve()
+else:
+    # Entry point for Vercel: it provides the Flask app instance to the runtime
+    from app.web import app